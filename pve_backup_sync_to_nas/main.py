@@ -1,95 +1,156 @@
 """PVE backup sync to NAS - Main module"""
 
+import functools
+import hashlib
+import http.client
+import json
 import logging
+import logging.handlers
 import os
+import queue
+import re
+import shutil
+import socket
 import subprocess
+import sys
+import tempfile
 import time
 import tomllib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
 from typing import Optional
-
-import paramiko
-import requests
-from ping3 import ping
-from wakeonlan import send_magic_packet
+from urllib.parse import urlsplit
 
 
 # ==================== Configuration ====================
 
 
-@dataclass
-class NASConfig:
-    """NAS connection configuration"""
-
-    mac_address: str
-    ip: str
-    ssh_user: str = "admin"
-    ssh_port: int = 22
-    ssh_key: Optional[str] = None
+@dataclass(slots=True, frozen=True)
+class Config:
+    """Flat configuration, fields are prefixed with their TOML section name"""
+
+    # [nas] NAS connection
+    nas_mac_address: str
+    nas_ip: str
+    # [backup]
+    backup_local_dir: str
+    backup_nas_dir: str
+
+    # [nas]
+    nas_ssh_user: str = "admin"
+    nas_ssh_port: int = 22
+    nas_ssh_key: Optional[str] = None
     # Wait settings
-    max_wait_time: int = 300
-    ping_interval: int = 5
-    ssh_ready_wait: int = 30
+    nas_max_wait_time: int = 300
+    # Upper bound of the exponential backoff between probes
+    nas_ping_interval: int = 8
+    # Deprecated, no longer used (kept so old config files still load)
+    nas_ssh_ready_wait: int = 0
+
+    # [backup]
+    backup_rsync_options: str = (
+        "-ahP --delete --partial-dir=.rsync-partial --delay-updates"
+    )
+    # Compare full file checksums instead of size+mtime (slow, for verification runs)
+    backup_integrity_check: bool = False
+    # Number of concurrent rsync processes, sharded by top-level entry
+    backup_parallel_jobs: int = 4
+    # Transfer to an rsync daemon on the NAS instead of rsync over SSH
+    backup_use_rsyncd: bool = False
+    backup_rsyncd_module: Optional[str] = None
+    # Skip waking the NAS when nothing changed since the last successful backup
+    backup_skip_if_unchanged: bool = True
+    # Defaults to a file under /var/lib/pve-backup-sync keyed on source and target
+    backup_state_file: Optional[str] = None
+    # Command run on the NAS after a successful rsync, e.g. "sudo zpool scrub tank"
+    backup_post_scrub_command: Optional[str] = None
+    # Shut the NAS down even while the scrub runs (only safe for resumable
+    # scrubs such as ZFS; a btrfs scrub is aborted and never completes)
+    backup_shutdown_after_scrub: bool = False
+
+    # [log]
+    log_file: str = "/var/log/pve_backup_sync_to_nas.log"
+    log_level: str = "INFO"
 
+    # [notification]
+    notification_enabled: bool = False
+    notification_discord_webhook: Optional[str] = None
+    notification_on_success: bool = True
+    notification_on_failure: bool = True
 
-@dataclass
-class BackupConfig:
-    """Backup configuration"""
 
-    local_dir: str
-    nas_dir: str
-    rsync_options: str = "-avhP --delete --checksum"
+_CONFIG_SECTIONS = ("nas", "backup", "log", "notification")
 
 
-@dataclass
-class LogConfig:
-    """Logging configuration"""
+def load_config(config_path: str) -> Config:
+    """Load configuration from TOML file (cached until the file changes)"""
+    try:
+        mtime_ns = os.stat(config_path).st_mtime_ns
+    except FileNotFoundError:
+        raise FileNotFoundError(
+            f"Configuration file not found: {config_path}\n"
+            f"Please create config.toml from config.example.toml"
+        ) from None
 
-    log_file: str = "/var/log/pve_backup_sync_to_nas.log"
-    log_level: str = "INFO"
+    return _load_config_cached(config_path, mtime_ns)
 
 
-@dataclass
-class NotificationConfig:
-    """Notification configuration"""
+@functools.lru_cache(maxsize=4)
+def _load_config_cached(config_path: str, mtime_ns: int) -> Config:
+    """Parse TOML config, keyed on path and mtime so edits are picked up"""
+    with open(config_path, "rb") as f:
+        data = tomllib.load(f)
 
-    enabled: bool = False
-    discord_webhook: Optional[str] = None
-    on_success: bool = True
-    on_failure: bool = True
+    # Flatten [section] key into section_key ("log_file" stays "log_file")
+    fields = {}
+    for section in _CONFIG_SECTIONS:
+        for key, value in data.get(section, {}).items():
+            name = key if key.startswith(f"{section}_") else f"{section}_{key}"
+            fields[name] = value
 
+    if fields.get("nas_ssh_key"):
+        fields["nas_ssh_key"] = os.path.expanduser(fields["nas_ssh_key"])
 
-@dataclass
-class Config:
-    """Main configuration container"""
+    config = Config(**fields)
 
-    nas: NASConfig
-    backup: BackupConfig
-    log: LogConfig
-    notification: NotificationConfig
+    # Fail before the NAS is woken up, not halfway through the run
+    if config.backup_use_rsyncd and not config.backup_rsyncd_module:
+        raise ValueError("rsyncd_module must be set when use_rsyncd is on")
 
+    return config
 
-def load_config(config_path: str) -> Config:
-    """Load configuration from TOML file"""
-    config_file = Path(config_path)
 
-    if not config_file.exists():
-        raise FileNotFoundError(
-            f"Configuration file not found: {config_path}\n"
-            f"Please create config.toml from config.example.toml"
-        )
+# ==================== Logging ====================
 
-    with open(config_file, "rb") as f:
-        data = tomllib.load(f)
 
-    return Config(
-        nas=NASConfig(**data.get("nas", {})),
-        backup=BackupConfig(**data.get("backup", {})),
-        log=LogConfig(**data.get("log", {})),
-        notification=NotificationConfig(**data.get("notification", {})),
+def setup_logging(config: Config) -> logging.handlers.QueueListener:
+    """
+    Setup logging with file/console writes done on a background thread
+
+    Returns:
+        The started queue listener, stop it before exiting to flush records
+    """
+    log_level = getattr(logging, config.log_level.upper(), logging.INFO)
+    formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+
+    handlers = [logging.FileHandler(config.log_file), logging.StreamHandler()]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(
+        log_queue, *handlers, respect_handler_level=True
     )
+    listener.start()
+
+    root = logging.getLogger()
+    root.setLevel(log_level)
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+
+    return listener
 
 
 # ==================== Notification ====================
@@ -135,27 +196,77 @@ def send_discord_notification(
     }
 
     try:
-        response = requests.post(webhook_url, json=payload, timeout=10)
-        response.raise_for_status()
+        url = urlsplit(webhook_url)
+        path = f"{url.path}?{url.query}" if url.query else url.path
+        conn = http.client.HTTPSConnection(url.netloc, timeout=10)
+        try:
+            conn.request(
+                "POST",
+                path,
+                body=json.dumps(payload),
+                headers={
+                    "Content-Type": "application/json",
+                    "User-Agent": "pve-auto-scripts",
+                },
+            )
+            response = conn.getresponse()
+            response.read()
+            if not 200 <= response.status < 300:
+                raise Exception(f"HTTP {response.status} {response.reason}")
+        finally:
+            conn.close()
         logging.info("Discord notification sent")
     except Exception as e:
         logging.warning(f"Failed to send Discord notification: {e}")
 
 
+def humanize_bytes(num_bytes: int) -> str:
+    """Format a byte count as a human-readable size (like du -h)"""
+    size = float(num_bytes)
+    for unit in ["B", "K", "M", "G", "T"]:
+        if size < 1024:
+            return f"{size:.1f}{unit}" if unit != "B" else f"{int(size)}B"
+        size /= 1024
+    return f"{size:.1f}P"
+
+
+_TOTAL_SIZE_RE = re.compile(r"Total file size:\s*([\d,.]+)([KMGTP]?)")
+
+
+def _parse_total_size(lines) -> Optional[int]:
+    """Parse "Total file size" in bytes from rsync --stats output"""
+    for line in reversed(lines):
+        match = _TOTAL_SIZE_RE.search(line)
+        if match:
+            number, suffix = match.groups()
+            # With -h rsync prints units of 1000 (e.g. "1.23G")
+            multiplier = 1000 ** " KMGTP".index(suffix or " ")
+            try:
+                return int(float(number.replace(",", "")) * multiplier)
+            except ValueError:
+                return None
+    return None
+
+
+def _entry_size(entry: os.DirEntry) -> int:
+    """Get total size in bytes of a directory entry (recursive for directories)"""
+    try:
+        if entry.is_dir(follow_symlinks=False):
+            with os.scandir(entry.path) as it:
+                return sum(_entry_size(child) for child in it)
+        return entry.stat(follow_symlinks=False).st_size
+    except OSError:
+        return 0
+
+
 def get_directory_size(path: str) -> str:
-    """Get human-readable directory size"""
+    """Get human-readable directory size, walking top-level entries in parallel"""
     try:
-        result = subprocess.run(
-            ["du", "-sh", path],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            timeout=30,
-        )
-        if result.returncode == 0:
-            size = result.stdout.split()[0]
-            return size
-        return "Unknown"
+        with os.scandir(path) as it:
+            entries = list(it)
+        # stat() releases the GIL, so threads overlap the I/O waits
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+            return humanize_bytes(sum(pool.map(_entry_size, entries)))
     except Exception:
         return "Unknown"
 
@@ -166,129 +277,149 @@ def get_directory_size(path: str) -> str:
 class NASBackup:
     """NAS Backup Manager Class"""
 
-    def __init__(self, nas: NASConfig, backup: BackupConfig, log: LogConfig):
+    def __init__(self, config: Config):
         """
         Initialize NAS Backup Manager
 
         Args:
-            nas: NAS configuration
-            backup: Backup configuration
-            log: Logging configuration
+            config: Configuration
         """
-        self.nas = nas
-        self.backup = backup
-        self.log = log
-
-        # Convenience attributes
-        self.nas_ip = nas.ip
-        self.nas_mac = nas.mac_address
-        self.ssh_user = nas.ssh_user
-        self.ssh_port = nas.ssh_port
-        self.ssh_key = Path(nas.ssh_key).expanduser() if nas.ssh_key else None
-        self.ssh_client = None
-
-        self._setup_logging()
-
-    def _setup_logging(self):
-        """Setup logging configuration"""
-        log_level = getattr(logging, self.log.log_level.upper(), logging.INFO)
-
-        logging.basicConfig(
-            level=log_level,
-            format="%(asctime)s - %(levelname)s - %(message)s",
-            handlers=[logging.FileHandler(self.log.log_file), logging.StreamHandler()],
-        )
+        self.config = config
+        self._ssh_target = f"{config.nas_ssh_user}@{config.nas_ip}"
+
+        # One state file per source/target pair, so separate configs don't
+        # make each other skip
+        if config.backup_state_file:
+            self._state_file = config.backup_state_file
+        else:
+            key = "\0".join(
+                [
+                    config.backup_local_dir,
+                    self._ssh_target,
+                    config.backup_nas_dir,
+                    config.backup_rsyncd_module or "",
+                ]
+            )
+            digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+            self._state_file = f"/var/lib/pve-backup-sync/last-{digest}"
+
+        # OpenSSH ControlMaster socket shared by ssh and rsync
+        runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or f"/run/user/{os.getuid()}"
+        self._cm_tmp_dir = None
+        if not os.path.isdir(runtime_dir):
+            # Private 0700 dir, a fixed path in /tmp could be pre-created by others
+            self._cm_tmp_dir = tempfile.mkdtemp(prefix="pve-sync-")
+            runtime_dir = self._cm_tmp_dir
+        self._cm_socket = os.path.join(runtime_dir, f"pve-sync-{config.nas_ip}.sock")
+        self._cm_active = False
+
+        # Total size reported by the last rsync --stats run
+        self.last_backup_size = None
+        # Last lines of output from the last failed rsync run
+        self.last_rsync_error = None
 
     def send_wol(self):
         """Send WOL packet to wake NAS"""
+        # Imported lazily to keep startup and config-error paths fast
+        from wakeonlan import send_magic_packet
+
         try:
-            send_magic_packet(self.nas_mac)
-            logging.info(f"WOL packet sent to {self.nas_mac}")
+            send_magic_packet(self.config.nas_mac_address)
+            logging.info(f"WOL packet sent to {self.config.nas_mac_address}")
             return True
         except Exception as e:
             logging.error(f"Failed to send WOL packet: {e}")
             return False
 
-    def ping_host(self, timeout=1):
-        """Check if host is online"""
-        try:
-            result = ping(self.nas_ip, timeout=timeout)
-            return result is not None
-        except Exception:
-            return False
-
     def check_ssh_ready(self, timeout=5):
-        """Check if SSH service is ready"""
+        """Check if SSH service is ready (sshd sends its version banner)"""
         try:
-            client = paramiko.SSHClient()
-            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            client.connect(
-                self.nas_ip,
-                port=self.ssh_port,
-                username=self.ssh_user,
-                key_filename=str(self.ssh_key) if self.ssh_key else None,
-                timeout=timeout,
-                look_for_keys=True,
-                allow_agent=True,
-            )
-            client.close()
-            return True
-        except Exception:
+            with socket.create_connection(
+                (self.config.nas_ip, self.config.nas_ssh_port), timeout=timeout
+            ) as sock:
+                sock.settimeout(timeout)
+                banner = sock.recv(256)
+            return banner.startswith(b"SSH-")
+        except (OSError, socket.timeout):
             return False
 
-    def wait_for_online(self):
-        """Wait for NAS to be online and ready"""
-        max_wait = self.nas.max_wait_time
-        check_interval = self.nas.ping_interval
-        ssh_wait = self.nas.ssh_ready_wait
+    def wait_for_online(self, abort=None):
+        """
+        Wait for NAS to be online and ready
+
+        Args:
+            abort: Optional callable, polling stops early when it returns True
+        """
+        max_wait = self.config.nas_max_wait_time
+        max_interval = self.config.nas_ping_interval
 
-        logging.info(f"Waiting for NAS ({self.nas_ip}) to come online...")
+        logging.info(f"Waiting for NAS ({self.config.nas_ip}) to come online...")
         start_time = time.time()
+        delay = 0.5
 
-        # Phase 1: Wait for ping response
+        # Poll with exponential backoff, returning on the first SSH success
         while time.time() - start_time < max_wait:
-            if self.ping_host():
-                logging.info(f"NAS responded to ping")
-                break
-            time.sleep(check_interval)
-        else:
-            logging.error(f"Timeout ({max_wait} seconds), NAS did not respond to ping")
-            return False
-
-        # Phase 2: Wait for SSH service to be ready
-        logging.info("Waiting for SSH service to be ready...")
-        time.sleep(ssh_wait)
-
-        retry_count = 0
-        while retry_count < 10:
-            if self.check_ssh_ready():
+            if self.check_ssh_ready(timeout=2):
                 logging.info("SSH service is ready")
                 return True
-            retry_count += 1
-            time.sleep(5)
+            if abort and abort():
+                return False
+            time.sleep(delay)
+            delay = min(delay * 1.5, max_interval)
 
-        logging.error("SSH service not ready after retries")
+        logging.error(f"Timeout ({max_wait} seconds), SSH service not ready")
         return False
 
+    def _ssh_cmd(self, *args):
+        """Build an ssh command that reuses the ControlMaster socket"""
+        return [
+            "/usr/bin/ssh",
+            "-o",
+            f"ControlPath={self._cm_socket}",
+            "-p",
+            str(self.config.nas_ssh_port),
+            *args,
+        ]
+
     def connect_ssh(self):
-        """Establish SSH connection"""
-        try:
-            self.ssh_client = paramiko.SSHClient()
-            self.ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
-            connect_kwargs = {
-                "hostname": self.nas_ip,
-                "port": self.ssh_port,
-                "username": self.ssh_user,
-                "timeout": 10,
-                "look_for_keys": True,
-                "allow_agent": True,
-            }
+        """Establish SSH ControlMaster connection shared by later ssh/rsync calls"""
+        cmd = self._ssh_cmd(
+            "-M",
+            "-N",
+            "-f",
+            "-o",
+            "ControlPersist=600",
+            "-o",
+            "ServerAliveInterval=30",
+            "-o",
+            "BatchMode=yes",
+            "-o",
+            "StrictHostKeyChecking=accept-new",
+            "-o",
+            "ConnectTimeout=10",
+        )
+        ssh_key = self.config.nas_ssh_key
+        if ssh_key and os.path.exists(ssh_key):
+            cmd.extend(["-i", ssh_key])
+        cmd.append(self._ssh_target)
 
-            if self.ssh_key and self.ssh_key.exists():
-                connect_kwargs["key_filename"] = str(self.ssh_key)
+        try:
+            # ssh -f keeps running in background, so don't wait on its pipes
+            with tempfile.TemporaryFile() as err:
+                result = subprocess.run(
+                    cmd,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=err,
+                    timeout=30,
+                )
+                if result.returncode != 0:
+                    err.seek(0)
+                    message = err.read().decode("utf-8", errors="replace").strip()
+                    logging.error(f"SSH connection failed: {message}")
+                    return False
 
-            self.ssh_client.connect(**connect_kwargs)
+            self._cm_active = True
             logging.info("SSH connection established")
             return True
         except Exception as e:
@@ -297,100 +428,364 @@ class NASBackup:
 
     def execute_ssh_command(self, command):
         """Execute SSH command"""
-        if not self.ssh_client:
+        if not self._cm_active:
             return None, None, False
 
         try:
-            stdin, stdout, stderr = self.ssh_client.exec_command(command, timeout=30)
-            exit_status = stdout.channel.recv_exit_status()
-            output = stdout.read().decode("utf-8")
-            error = stderr.read().decode("utf-8")
-            return output, error, (exit_status == 0)
+            # run() drains stdout and stderr concurrently, so a chatty stderr
+            # can't stall the remote command
+            result = subprocess.run(
+                self._ssh_cmd(self._ssh_target, command),
+                stdin=subprocess.DEVNULL,
+                capture_output=True,
+                encoding="utf-8",
+                errors="replace",
+                timeout=30,
+            )
+            return result.stdout, result.stderr, (result.returncode == 0)
         except Exception as e:
             logging.error(f"Failed to execute SSH command: {e}")
             return None, str(e), False
 
     def close_ssh(self):
         """Close SSH connection"""
-        if self.ssh_client:
-            self.ssh_client.close()
+        if self._cm_active:
+            subprocess.run(
+                self._ssh_cmd("-O", "exit", self._ssh_target),
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            self._cm_active = False
             logging.info("SSH connection closed")
 
+        if self._cm_tmp_dir:
+            shutil.rmtree(self._cm_tmp_dir, ignore_errors=True)
+            self._cm_tmp_dir = None
+
+    def _read_last_success(self):
+        """Read the start time (ns) of the last successful rsync, if recorded"""
+        try:
+            with open(self._state_file) as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            return None
+
+    def _write_state(self, path, timestamp_ns):
+        """Write a timestamp (ns) to a state file"""
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(f"{timestamp_ns}\n")
+        except OSError as e:
+            logging.warning(f"Failed to write state file: {e}")
+
+    def _write_last_success(self, timestamp_ns):
+        """Record the start time (ns) of a successful rsync"""
+        self._write_state(self._state_file, timestamp_ns)
+
+    def write_skip_sentinel(self):
+        """Record when a run was skipped because nothing changed"""
+        self._write_state(f"{self._state_file}.skipped", time.time_ns())
+
+    def _source_has_changes_since(self, timestamp_ns):
+        """Check if any entry under local_dir was modified after timestamp_ns"""
+        source_dir = self.config.backup_local_dir
+        # Deleting or renaming an entry updates its parent directory's mtime
+        if os.stat(source_dir).st_mtime_ns > timestamp_ns:
+            return True
+
+        dirs = [source_dir]
+        while dirs:
+            with os.scandir(dirs.pop()) as it:
+                for entry in it:
+                    st = entry.stat(follow_symlinks=False)
+                    # ctime also catches files copied in with preserved mtime
+                    if max(st.st_mtime_ns, st.st_ctime_ns) > timestamp_ns:
+                        return True
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+        return False
+
+    def has_source_changes(self):
+        """Check if local_dir changed since the last successful backup"""
+        # A verification run must always compare contents
+        if (
+            not self.config.backup_skip_if_unchanged
+            or self.config.backup_integrity_check
+        ):
+            return True
+
+        last_success = self._read_last_success()
+        if last_success is None:
+            return True
+
+        try:
+            return self._source_has_changes_since(last_success)
+        except OSError as e:
+            logging.warning(f"Failed to scan source directory for changes: {e}")
+            return True
+
+    def _split_shards(self, source_dir):
+        """Bin-pack top-level entries of source_dir into roughly equal-size shards"""
+        # Sizing walks the whole tree, don't pay for it without parallelism
+        if self.config.backup_parallel_jobs <= 1:
+            return []
+
+        entries = []
+        with os.scandir(source_dir) as it:
+            for entry in it:
+                entries.append((_entry_size(entry), entry.name))
+
+        shard_count = min(self.config.backup_parallel_jobs, len(entries))
+        if shard_count <= 1:
+            return []
+
+        # Greedy: largest entry goes into the currently smallest shard
+        shards = [[0, []] for _ in range(shard_count)]
+        for size, name in sorted(entries, reverse=True):
+            shard = min(shards, key=lambda s: s[0])
+            shard[0] += size
+            shard[1].append(name)
+
+        return [names for _, names in shards if names]
+
+    def _run_rsync(self, cmd, env):
+        """Run a single rsync process, streaming its output
+
+        Returns:
+            Tuple of (exit code, last lines of output)
+        """
+        process = subprocess.Popen(
+            cmd,
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            bufsize=-1,
+        )
+        os.set_blocking(process.stdout.fileno(), True)
+
+        # Forward output in bulk, keeping only the last lines for --stats/errors
+        tail = deque(maxlen=200)
+        pending = b""
+        while chunk := process.stdout.read1(65536):
+            sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+
+            lines = (pending + chunk).splitlines()
+            # Hold back an incomplete last line until the next chunk
+            pending = b"" if chunk.endswith((b"\n", b"\r")) else lines.pop()
+            tail.extend(lines)
+        if pending:
+            tail.append(pending)
+
+        # Wait for process to complete
+        process.wait()
+        return process.returncode, [line.decode(errors="replace") for line in tail]
+
     def rsync_backup(self):
         """Execute Rsync backup"""
-        source_dir = self.backup.local_dir
-        target_dir = self.backup.nas_dir
-        rsync_opts = self.backup.rsync_options
+        source_dir = self.config.backup_local_dir
+        target_dir = self.config.backup_nas_dir
+        rsync_opts = self.config.backup_rsync_options.split()
+        rsync_opts.append("--stats")
+
+        partial_opts = [
+            opt
+            for opt in rsync_opts
+            if opt.startswith("--partial-dir") or opt == "--delay-updates"
+        ]
+
+        if self.config.backup_integrity_check:
+            rsync_opts.append("--checksum")
+        elif partial_opts:
+            # --inplace conflicts with --partial-dir/--delay-updates, and resuming
+            # from a partial file needs the delta algorithm, so keep -W off
+            rsync_opts.append("--preallocate")
+        else:
+            # Dump files are rewritten whole, skip the delta algorithm on LAN
+            rsync_opts.extend(["-W", "--inplace", "--preallocate"])
 
         try:
-            if not Path(source_dir).exists():
+            try:
+                os.stat(source_dir)
+            except FileNotFoundError:
                 logging.error(f"Source directory does not exist: {source_dir}")
                 return False
 
-            target = f"{self.ssh_user}@{self.nas_ip}:{target_dir}"
+            # C locale keeps --stats numbers parseable ("1,234" not "1.234")
+            env = os.environ.copy()
+            env["LC_ALL"] = "C"
 
-            # Build rsync command with proper SSH path
-            if self.ssh_key and self.ssh_key.exists():
-                # Use RSYNC_RSH environment variable instead
-                env = os.environ.copy()
-                env['RSYNC_RSH'] = f"/usr/bin/ssh -i {self.ssh_key} -p {self.ssh_port}"
-                
-                cmd = ["/usr/bin/rsync"]
-                cmd.extend(rsync_opts.split())
-                cmd.extend([f"{source_dir}/", f"{target}/"])
+            if self.config.backup_use_rsyncd:
+                # rsync protocol over plain TCP, the module defines the NAS path
+                target = (
+                    f"rsync://{self._ssh_target}/{self.config.backup_rsyncd_module}"
+                )
             else:
-                cmd = ["/usr/bin/rsync"]
-                cmd.extend(rsync_opts.split())
-                cmd.extend([f"{source_dir}/", f"{target}/"])
-                env = None
-
-            logging.info(f"Starting Rsync backup...")
-            logging.info(f"Command: {' '.join(cmd)}")
-
-            # Use Popen for real-time output
-            process = subprocess.Popen(
-                cmd,
-                env=env,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-                bufsize=1,
-                universal_newlines=True,
-            )
+                target = f"{self._ssh_target}:{target_dir}"
 
-            # Print output in real-time
-            for line in process.stdout:
-                print(line, end="")
+                # Reuse the ControlMaster connection, which already holds the key
+                env["RSYNC_RSH"] = " ".join(self._ssh_cmd())
 
-            # Wait for process to complete
-            process.wait()
+            cmd = ["/usr/bin/rsync"]
+            cmd.extend(rsync_opts)
 
-            if process.returncode == 0:
+            shards = self._split_shards(source_dir)
+            start_ns = time.time_ns()
+
+            if not shards:
+                cmd.extend([f"{source_dir}/", f"{target}/"])
+                logging.info(f"Starting Rsync backup...")
+                logging.info(f"Command: {' '.join(cmd)}")
+                results = [self._run_rsync(cmd, env)]
+            else:
+                logging.info(
+                    f"Starting Rsync backup with {len(shards)} parallel jobs..."
+                )
+                with tempfile.TemporaryDirectory(prefix="pve-sync-") as tmp_dir:
+                    shard_cmds = []
+                    for i, names in enumerate(shards):
+                        files_from = Path(tmp_dir) / f"shard-{i}.txt"
+                        # NUL-terminated "./name" entries, so names starting with
+                        # "#" or ";" or containing newlines are not mangled
+                        files_from.write_bytes(
+                            b"".join(b"./" + os.fsencode(n) + b"\0" for n in names)
+                        )
+                        # --files-from disables the recursion implied by -a
+                        shard_cmd = cmd + [
+                            "-r",
+                            "--from0",
+                            f"--files-from={files_from}",
+                            f"{source_dir}/",
+                            f"{target}/",
+                        ]
+                        logging.info(f"Command: {' '.join(shard_cmd)}")
+                        shard_cmds.append(shard_cmd)
+
+                    with ThreadPoolExecutor(max_workers=len(shard_cmds)) as pool:
+                        results = list(
+                            pool.map(lambda c: self._run_rsync(c, env), shard_cmds)
+                        )
+
+            sizes = [_parse_total_size(tail) for _, tail in results]
+            if None not in sizes:
+                self.last_backup_size = humanize_bytes(sum(sizes))
+
+            # Shards only delete inside the entries they transfer, so remove
+            # top-level entries that no longer exist locally in a final pass
+            # (--delay-updates also starts with "--del", so match explicitly)
+            deletes = any(
+                opt == "--del" or opt.startswith("--delete") for opt in rsync_opts
+            )
+            if shards and deletes and all(rc == 0 for rc, _ in results):
+                # Keep the user's options (dry-run, filters, auth, partial dir)
+                # but skip checksumming; transfer nothing, just delete
+                cleanup_cmd = ["/usr/bin/rsync"]
+                cleanup_cmd.extend(
+                    opt
+                    for opt in rsync_opts
+                    if opt not in ("--stats", "--checksum", "-c")
+                )
+                # Only the top level, the shards already deleted inside each entry
+                cleanup_cmd.extend(
+                    [
+                        "--no-r",
+                        "--dirs",
+                        "--no-progress",
+                        "--info=progress0",
+                        "--existing",
+                        "--ignore-existing",
+                        f"{source_dir}/",
+                        f"{target}/",
+                    ]
+                )
+                logging.info(f"Command: {' '.join(cleanup_cmd)}")
+                results.append(self._run_rsync(cleanup_cmd, env))
+
+            failed = [(rc, tail) for rc, tail in results if rc != 0]
+            if not failed:
                 logging.info("Rsync backup completed successfully")
+                self._write_last_success(start_ns)
                 return True
             else:
-                logging.error(f"Rsync failed (return code: {process.returncode})")
+                _, tail = failed[0]
+                self.last_rsync_error = "\n".join(tail[-20:])
+                logging.error(
+                    f"Rsync failed (return codes: {[rc for rc, _ in failed]})"
+                )
+                logging.debug("Rsync output:\n" + "\n".join(tail))
                 return False
 
         except Exception as e:
             logging.error(f"Rsync execution exception: {e}")
             return False
 
+    def start_scrub(self):
+        """Start filesystem scrub on the NAS (does not wait for it to finish)"""
+        command = self.config.backup_post_scrub_command
+        logging.info(f"Starting scrub on NAS: {command}")
+
+        if self.config.backup_shutdown_after_scrub and "zpool" not in command:
+            logging.warning(
+                "shutdown_after_scrub is on but the scrub does not look like ZFS; "
+                "non-resumable scrubs (e.g. btrfs) will never complete"
+            )
+
+        _, error, ok = self.execute_ssh_command(command)
+        if ok:
+            logging.info("Scrub started")
+        else:
+            logging.warning(f"Failed to start scrub: {error}")
+        return ok
+
     def shutdown_nas(self):
         """Shutdown NAS"""
         try:
             logging.info("Shutting down NAS...")
 
-            if self.ssh_client:
+            if self._cm_active:
+                # Runs over the ControlMaster socket; don't wait on the dying sshd
                 try:
-                    self.ssh_client.exec_command("sudo shutdown -h now", timeout=5)
+                    result = subprocess.run(
+                        self._ssh_cmd(self._ssh_target, "sudo shutdown -h now"),
+                        stdin=subprocess.DEVNULL,
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.PIPE,
+                        encoding="utf-8",
+                        errors="replace",
+                        timeout=2,
+                    )
+                except subprocess.TimeoutExpired:
+                    logging.info(
+                        "Shutdown command sent (connection interruption is normal)"
+                    )
+                    return True
+
+                if result.returncode == 0:
                     logging.info("Shutdown command sent")
                     return True
-                except Exception:
+
+                # ssh also exits 255 when it cannot connect or authenticate, so
+                # only a connection dropped by the powering-off NAS counts
+                if result.returncode == 255 and any(
+                    msg in result.stderr
+                    for msg in (
+                        "closed by remote host",
+                        "Connection reset by",
+                        "Broken pipe",
+                    )
+                ):
                     logging.info(
                         "Shutdown command sent (connection interruption is normal)"
                     )
                     return True
+
+                logging.error(
+                    f"Shutdown command failed (exit code {result.returncode}): "
+                    f"{result.stderr.strip()}"
+                )
+                return False
             else:
                 logging.error("SSH client not connected, cannot shutdown")
                 return False
@@ -405,8 +800,6 @@ class NASBackup:
 
 def main():
     """Entry point for CLI"""
-    import sys
-
     if len(sys.argv) < 2:
         print("Usage: pve-backup-sync-to-nas <config.toml>")
         sys.exit(1)
@@ -417,6 +810,9 @@ def main():
     except FileNotFoundError as e:
         print(f"Error: {e}")
         sys.exit(1)
+    except ValueError as e:
+        print(f"Invalid configuration: {e}")
+        sys.exit(1)
     except Exception as e:
         print(f"Failed to load configuration: {e}")
         import traceback
@@ -424,8 +820,10 @@ def main():
         traceback.print_exc()
         sys.exit(1)
 
+    log_listener = setup_logging(config)
+
     # Initialize backup manager
-    backup = NASBackup(config.nas, config.backup, config.log)
+    backup = NASBackup(config)
 
     # Track execution
     start_time = time.time()
@@ -439,14 +837,25 @@ def main():
         logging.info(f"Execution time: {datetime.now()}")
         logging.info("=" * 60)
 
-        # Step 1: Wake NAS
-        logging.info("\n[Step 1] Wake NAS")
-        if not backup.send_wol():
-            raise Exception("Failed to send WOL packet")
+        if not backup.has_source_changes():
+            logging.info("No changes since last successful backup, skipping wake")
+            backup.write_skip_sentinel()
+            success = True
+            return
 
-        # Step 2: Wait for NAS to be online
+        # Step 1 + 2: Wake NAS and wait for it to be online
+        # Probing starts right away, overlapping the WOL send with the boot wait
+        logging.info("\n[Step 1] Wake NAS")
         logging.info("\n[Step 2] Wait for NAS to be online")
-        if not backup.wait_for_online():
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            wol = pool.submit(backup.send_wol)
+            online = backup.wait_for_online(
+                abort=lambda: wol.done() and not wol.result()
+            )
+
+        if not online:
+            if not wol.result():
+                raise Exception("Failed to send WOL packet")
             raise Exception("NAS failed to come online")
 
         # Connect SSH
@@ -456,14 +865,26 @@ def main():
         # Step 3: Execute Rsync backup
         logging.info("\n[Step 3] Execute Rsync backup")
         if not backup.rsync_backup():
+            if backup.last_rsync_error:
+                raise Exception(f"Backup failed:\n{backup.last_rsync_error}")
             raise Exception("Backup failed")
 
-        # Get backup size
-        file_size = get_directory_size(config.backup.local_dir)
+        # Get backup size reported by rsync --stats, walk the source as fallback
+        file_size = backup.last_backup_size or get_directory_size(
+            config.backup_local_dir
+        )
+
+        # Let the NAS filesystem verify data integrity instead of --checksum
+        scrub_started = False
+        if config.backup_post_scrub_command:
+            scrub_started = backup.start_scrub()
 
         # Step 4: Shutdown NAS
         logging.info("\n[Step 4] Shutdown NAS")
-        if not backup.shutdown_nas():
+        if scrub_started and not config.backup_shutdown_after_scrub:
+            # Powering off would interrupt the scrub before it finishes
+            logging.info("Scrub running, leaving NAS on (shutdown_after_scrub is off)")
+        elif not backup.shutdown_nas():
             logging.warning("Failed to shutdown NAS, please check manually")
 
         # Success
@@ -491,20 +912,23 @@ def main():
         duration = time.time() - start_time
 
         # Send notification if enabled
-        if config.notification.enabled:
-            should_notify = (success and config.notification.on_success) or (
-                not success and config.notification.on_failure
+        if config.notification_enabled:
+            should_notify = (success and config.notification_on_success) or (
+                not success and config.notification_on_failure
             )
 
-            if should_notify and config.notification.discord_webhook:
+            if should_notify and config.notification_discord_webhook:
                 send_discord_notification(
-                    webhook_url=config.notification.discord_webhook,
+                    webhook_url=config.notification_discord_webhook,
                     success=success,
                     duration=duration,
                     file_size=file_size,
                     error_msg=error_msg,
                 )
 
+        # Flush queued log records
+        log_listener.stop()
+
         # Exit with appropriate code
         sys.exit(0 if success else 1)
 